@@ -5,7 +5,7 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
@@ -17,16 +17,42 @@ load_dotenv()
 
 _client = None
 db = None
+_bucket = None
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
+# Pool sizes are per process: every server worker has its own client, so
+# MongoDB sees up to workers * max_pool_size connections (and keeps
+# workers * min_pool_size open when idle). Size the *total* against the
+# database server, roughly (2 * its cores) + effective spindle count, then
+# divide by the worker count. min_pool_size keeps warm connections ready so
+# the first requests don't pay for TCP/TLS/auth handshakes.
+max_pool_size = int(os.getenv("DATABASE_MAX_POOL_SIZE", 50))
+min_pool_size = int(os.getenv("DATABASE_MIN_POOL_SIZE", 10))
+
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # One shared client per process; Motor binds to the running loop on first use
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=max_pool_size,
+        minPoolSize=min_pool_size,
+        serverSelectionTimeoutMS=3000,
+    )
     db = _client[database_name]
 
+def get_bucket():
+    """GridFS bucket for file contents (no 16 MB document limit, chunked I/O)"""
+    global _bucket
+    # Built on first use because the bucket binds to the current event loop,
+    # unlike the client; creating it at import breaks servers that start their
+    # loop afterwards (python main.py, spawned workers)
+    if _bucket is None and db is not None:
+        _bucket = AsyncIOMotorGridFSBucket(db)
+    return _bucket
+
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -40,10 +66,10 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     data_dict['created_at'] = datetime.now(timezone.utc)
     data_dict['updated_at'] = datetime.now(timezone.utc)
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -52,4 +78,4 @@ def get_documents(collection_name: str, filter_dict: dict = None, limit: int = N
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(length=limit)
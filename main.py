@@ -1,26 +1,50 @@
+import asyncio
+import logging
 import os
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+import re
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
+from async_lru import alru_cache
+import aiofiles
+import aiofiles.os
 from typing import List, Optional
 
-from database import db, create_document, get_documents
+from database import db, get_bucket, create_document, get_documents
 from bson.objectid import ObjectId
+from bson.regex import Regex as BsonRegex
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
 
-app = FastAPI(title="Scan & Archive API", version="1.0.0")
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Scan & Archive API", version="1.0.0", default_response_class=ORJSONResponse)
+
+# Comma-separated explicit origins enable credentialed CORS; otherwise the API
+# is public and "*" is sent without credentials (no per-request origin echo)
+cors_origins = tuple(o.strip() for o in os.getenv("CORS_ALLOW_ORIGINS", "").split(",") if o.strip())
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=cors_origins or ("*",),
+    allow_credentials=bool(cors_origins),
+    allow_methods=("GET", "POST", "PUT", "DELETE"),
+    allow_headers=("authorization", "content-type"),
 )
 
 # Utility to build collection name
 DOC_COLLECTION = "document"
 FILE_COLLECTION = "fileblob"
+# Only the fields DocumentOut needs; keeps search/blob bookkeeping off the wire
+DOC_OUT_PROJECTION = {"title": 1, "tags": 1, "notes": 1, "mime_type": 1, "size": 1, "text_preview": 1}
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB reads from the multipart body
+# When set, uploads are stored as files here (served with FileResponse)
+# instead of in GridFS
+STORAGE_PATH = os.getenv("STORAGE_PATH")
+if STORAGE_PATH:
+    os.makedirs(STORAGE_PATH, exist_ok=True)
 
 # Schemas
 class DocumentCreate(BaseModel):
@@ -37,12 +61,81 @@ class DocumentOut(BaseModel):
     size: Optional[int] = None
     text_preview: Optional[str] = None
 
+def _search_fields(title: str, tags: List[str]) -> dict:
+    # Lowercased copies of the searchable fields so lookups can use plain indexes
+    return {"title_lc": title.lower(), "tags_lc": [t.lower() for t in tags]}
+
+async def _doc_oid(doc_id: str) -> ObjectId:
+    # Shared {doc_id} path check; is_valid avoids a try/except around ObjectId()
+    if not ObjectId.is_valid(doc_id):
+        raise HTTPException(status_code=400, detail="Invalid document id")
+    return ObjectId(doc_id)
+
+def _out_fields(d: dict) -> dict:
+    return {
+        "id": str(d["_id"]),
+        "title": d.get("title"),
+        "tags": d.get("tags") or [],
+        "notes": d.get("notes"),
+        "mime_type": d.get("mime_type"),
+        "size": d.get("size"),
+        "text_preview": d.get("text_preview"),
+    }
+
+def _to_out(d: dict) -> ORJSONResponse:
+    # Trusted data from our own writes/reads goes straight to orjson; the
+    # routes use response_model=None so FastAPI neither validates it again
+    # nor runs it through jsonable_encoder
+    return ORJSONResponse(_out_fields(d))
+
+# Response schema for the docs on routes that skip response validation
+DOC_OUT_RESPONSES = {200: {"model": DocumentOut}}
+
+@app.on_event("startup")
+async def warmup():
+    # Open the pool before serving so the first request isn't a cold connect;
+    # purely an optimization, so an unreachable database must not stop startup
+    if db is None:
+        return
+    try:
+        await db.command("ping")
+    except PyMongoError as e:
+        logger.warning("Database warm-up failed: %s", e)
+
+@app.on_event("startup")
+async def create_indexes():
+    if db is None:
+        return
+    try:
+        # Backfill search fields on documents written before they existed
+        await db[DOC_COLLECTION].update_many(
+            {"title_lc": {"$exists": False}},
+            [{"$set": {
+                "title_lc": {"$toLower": "$title"},
+                "tags_lc": {"$map": {"input": {"$ifNull": ["$tags", []]}, "in": {"$toLower": "$$this"}}},
+            }}],
+        )
+        await db[DOC_COLLECTION].create_index([("title_lc", 1)])
+        await db[DOC_COLLECTION].create_index([("tags_lc", 1)])
+        await db[DOC_COLLECTION].create_index([("created_at", -1)])
+        # Deletes find a document's files by doc_id
+        await db[FILE_COLLECTION].create_index([("doc_id", 1)])
+        await db["fs.files"].create_index([("metadata.doc_id", 1)])
+    except PyMongoError as e:
+        # Queries still work without these, just slower; don't block startup
+        logger.warning("Index setup failed: %s", e)
+
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Scan & Archive Backend Ready"}
 
 @app.get("/test")
-def test_database():
+async def test_database():
+    return await _db_status()
+
+# Health checkers hit /test often; share one admin call per TTL window
+@alru_cache(maxsize=1, ttl=5)
+async def _db_status():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -59,7 +152,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -72,7 +165,7 @@ def test_database():
     return response
 
 # Endpoint to create a document metadata first (without file)
-@app.post("/api/documents", response_model=DocumentOut)
+@app.post("/api/documents", response_model=None, responses=DOC_OUT_RESPONSES)
 async def create_document_metadata(payload: DocumentCreate):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
@@ -84,174 +177,248 @@ async def create_document_metadata(payload: DocumentCreate):
         "mime_type": None,
         "size": None,
         "text_preview": None,
+        **_search_fields(payload.title, payload.tags or []),
     }
 
-    inserted_id = create_document(DOC_COLLECTION, doc)
-    saved = db[DOC_COLLECTION].find_one({"_id": ObjectId(inserted_id)})
-    return {
-        "id": str(saved["_id"]),
-        "title": saved.get("title"),
-        "tags": saved.get("tags", []),
-        "notes": saved.get("notes"),
-        "mime_type": saved.get("mime_type"),
-        "size": saved.get("size"),
-        "text_preview": saved.get("text_preview"),
-    }
+    # We just wrote these exact fields, so answer without reading them back
+    inserted_id = await create_document(DOC_COLLECTION, doc)
+    return _to_out({**doc, "_id": inserted_id})
 
 # Upload file and attach to a document (by id)
-@app.post("/api/documents/{doc_id}/upload", response_model=DocumentOut)
-async def upload_document_file(doc_id: str, file: UploadFile = File(...)):
+@app.post("/api/documents/{doc_id}/upload", response_model=None, responses=DOC_OUT_RESPONSES)
+async def upload_document_file(oid: ObjectId = Depends(_doc_oid), file: UploadFile = File(...)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
+    # Naive text preview: if text or pdf, decode the first KB
+    wants_preview = bool(file.content_type and ("text" in file.content_type or file.content_type == "application/pdf"))
+
+    if STORAGE_PATH:
+        # Unique name per upload: the bytes only become visible once the
+        # document points at them, so a failed update never changes what is served
+        stored = f"{oid}.{ObjectId()}"
+        try:
+            async with aiofiles.open(_storage_file(stored), "wb") as out:
+                size, text_preview = await _copy_upload(file, out.write, wants_preview)
+        except Exception:
+            await _remove_file(_storage_file(stored))
+            raise
+        file_fields = {"storage_file": stored, "file_blob_id": None}
+    else:
+        # Stream the upload into GridFS chunk by chunk instead of buffering it all
+        grid_in = get_bucket().open_upload_stream(
+            file.filename or "file",
+            metadata={"content_type": file.content_type, "doc_id": oid},
+        )
+        try:
+            size, text_preview = await _copy_upload(file, grid_in.write, wants_preview)
+        except Exception:
+            await grid_in.abort()
+            raise
+        await grid_in.close()
+        stored = grid_in._id
+        file_fields = {"storage_file": None, "file_blob_id": stored}
+
+    fields = {
+        "mime_type": file.content_type,
+        "size": size,
+        "filename": file.filename,
+        "text_preview": text_preview,
+        **file_fields,
+    }
+
+    # Attach the file in a single round trip; BEFORE so a replaced local file
+    # can be removed, the response being that state with our $set applied
     try:
-        oid = ObjectId(doc_id)
+        previous = await db[DOC_COLLECTION].find_one_and_update(
+            {"_id": oid},
+            {"$set": fields},
+            projection={**DOC_OUT_PROJECTION, "storage_file": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
     except Exception:
-        raise HTTPException(status_code=400, detail="Invalid document id")
-
-    existing = db[DOC_COLLECTION].find_one({"_id": oid})
-    if not existing:
+        # Don't leave behind a file that no document points at
+        await _discard_stored_file(stored)
+        raise
+    if previous is None:
+        await _discard_stored_file(stored)
         raise HTTPException(status_code=404, detail="Document not found")
 
-    # Read file bytes
-    content = await file.read()
+    if STORAGE_PATH and previous.get("storage_file"):
+        await _remove_file(_storage_file(previous["storage_file"]))
 
-    # Store file into a separate collection as binary blob to keep things simple
-    blob = {
-        "doc_id": oid,
-        "filename": file.filename,
-        "content_type": file.content_type,
-        "size": len(content),
-        "content": content,  # stored as BSON binary
-    }
-    blob_id = create_document(FILE_COLLECTION, blob)
-
-    # Update document metadata
-    db[DOC_COLLECTION].update_one(
-        {"_id": oid},
-        {"$set": {"mime_type": file.content_type, "size": len(content), "file_blob_id": ObjectId(blob_id)}}
-    )
+    return _to_out({**previous, **fields})
 
-    updated = db[DOC_COLLECTION].find_one({"_id": oid})
+async def _iter_upload(file: UploadFile, chunk_size: int):
+    # Bounded reads so each chunk is written out before the next is pulled in
+    while chunk := await file.read(chunk_size):
+        yield chunk
 
-    # Naive text preview: if text or pdf, try to decode first KB
+async def _copy_upload(file: UploadFile, write, wants_preview: bool):
+    # Copy the upload through `write`; returns (size, text_preview)
+    size = 0
     text_preview = None
-    if file.content_type and ("text" in file.content_type or file.content_type == "application/pdf"):
-        try:
-            text_preview = content[:1024].decode(errors="ignore")
-        except Exception:
-            text_preview = None
-        db[DOC_COLLECTION].update_one({"_id": oid}, {"$set": {"text_preview": text_preview}})
-        updated = db[DOC_COLLECTION].find_one({"_id": oid})
+    async for chunk in _iter_upload(file, UPLOAD_CHUNK_SIZE):
+        await write(chunk)
+        size += len(chunk)
+        if wants_preview and text_preview is None:
+            text_preview = chunk[:1024].decode(errors="ignore")
+    return size, text_preview
 
-    return {
-        "id": str(updated["_id"]),
-        "title": updated.get("title"),
-        "tags": updated.get("tags", []),
-        "notes": updated.get("notes"),
-        "mime_type": updated.get("mime_type"),
-        "size": updated.get("size"),
-        "text_preview": updated.get("text_preview"),
-    }
+def _storage_file(name: str) -> str:
+    return os.path.join(STORAGE_PATH, name)
+
+async def _remove_file(path: str):
+    try:
+        await aiofiles.os.remove(path)
+    except FileNotFoundError:
+        pass
+
+async def _discard_stored_file(stored):
+    # `stored` is a file name under STORAGE_PATH or a GridFS file id
+    if STORAGE_PATH:
+        await _remove_file(_storage_file(stored))
+    else:
+        await _discard_grid_file(stored)
+
+async def _discard_grid_file(file_id):
+    # Best-effort cleanup: a file that is already gone, or an unreachable
+    # database, must not mask the error being reported
+    try:
+        await get_bucket().delete(file_id)
+    except PyMongoError:
+        pass
 
 # Download file content
 @app.get("/api/documents/{doc_id}/download")
-async def download_document_file(doc_id: str):
+async def download_document_file(oid: ObjectId = Depends(_doc_oid)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
-    try:
-        oid = ObjectId(doc_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid document id")
-
-    doc = db[DOC_COLLECTION].find_one({"_id": oid})
-    if not doc or not doc.get("file_blob_id"):
+    doc = await db[DOC_COLLECTION].find_one(
+        {"_id": oid}, {"file_blob_id": 1, "storage_file": 1, "mime_type": 1, "filename": 1}
+    )
+    if not doc or not (doc.get("file_blob_id") or doc.get("storage_file")):
         raise HTTPException(status_code=404, detail="File not found for this document")
 
-    blob = db[FILE_COLLECTION].find_one({"_id": doc["file_blob_id"]})
-    if not blob:
-        raise HTTPException(status_code=404, detail="File blob missing")
+    if doc.get("storage_file"):
+        path = _storage_file(doc["storage_file"]) if STORAGE_PATH else None
+        if path is None or not await aiofiles.os.path.exists(path):
+            raise HTTPException(status_code=404, detail="File blob missing")
+        # Let the server copy straight from the file instead of through Mongo
+        return FileResponse(path, media_type=doc.get("mime_type") or "application/octet-stream",
+                            filename=doc.get("filename") or "file")
 
-    return StreamingResponse(iter([blob["content"]]), media_type=blob.get("content_type") or "application/octet-stream",
-                             headers={"Content-Disposition": f"attachment; filename={blob.get('filename', 'file')}"})
+    try:
+        grid_out = await get_bucket().open_download_stream(doc["file_blob_id"])
+    except NoFile:
+        grid_out = None
+
+    if grid_out is None:
+        # Legacy uploads stored the whole file inline in the fileblob collection
+        blob = await db[FILE_COLLECTION].find_one({"_id": doc["file_blob_id"]})
+        if not blob:
+            raise HTTPException(status_code=404, detail="File blob missing")
+        body = iter([blob["content"]])
+        content_type = blob.get("content_type")
+        filename = blob.get("filename", "file")
+    else:
+        body = _iter_grid_out(grid_out)
+        content_type = (grid_out.metadata or {}).get("content_type")
+        filename = grid_out.filename or "file"
+
+    return StreamingResponse(body, media_type=content_type or "application/octet-stream",
+                             headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+async def _iter_grid_out(grid_out):
+    # Yield one GridFS chunk at a time so bytes hit the socket as they are read
+    while chunk := await grid_out.readchunk():
+        yield chunk
 
 # List documents
-@app.get("/api/documents", response_model=List[DocumentOut])
-async def list_documents(q: Optional[str] = None):
+# Same fast path as _to_out, for the whole page at once
+@app.get("/api/documents", response_model=None, responses={200: {"model": List[DocumentOut]}})
+async def list_documents(
+    q: Optional[str] = None,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=500),
+):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
     filter_query = {}
     if q:
-        # simple search on title or tags
+        # Case-insensitive title prefix or exact tag match, both served by indexes
+        q_lc = q.lower()
         filter_query = {"$or": [
-            {"title": {"$regex": q, "$options": "i"}},
-            {"tags": {"$elemMatch": {"$regex": q, "$options": "i"}}}
+            {"title_lc": BsonRegex(f"^{re.escape(q_lc)}")},
+            {"tags_lc": q_lc},
         ]}
 
-    docs = db[DOC_COLLECTION].find(filter_query).sort("created_at", -1)
-    results = []
-    for d in docs:
-        results.append({
-            "id": str(d["_id"]),
-            "title": d.get("title"),
-            "tags": d.get("tags", []),
-            "notes": d.get("notes"),
-            "mime_type": d.get("mime_type"),
-            "size": d.get("size"),
-            "text_preview": d.get("text_preview"),
-        })
-    return results
+    cursor = db[DOC_COLLECTION].find(filter_query, DOC_OUT_PROJECTION).sort("created_at", -1).skip(skip).limit(limit)
+    docs = await cursor.to_list(length=limit)
+    return ORJSONResponse([_out_fields(d) for d in docs])
 
 # Simple update for title/tags/notes
-@app.put("/api/documents/{doc_id}", response_model=DocumentOut)
-async def update_document(doc_id: str, payload: DocumentCreate):
+@app.put("/api/documents/{doc_id}", response_model=None, responses=DOC_OUT_RESPONSES)
+async def update_document(payload: DocumentCreate, oid: ObjectId = Depends(_doc_oid)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
-    try:
-        oid = ObjectId(doc_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid document id")
+    update = {
+        "title": payload.title,
+        "tags": payload.tags or [],
+        "notes": payload.notes,
+        **_search_fields(payload.title, payload.tags or []),
+    }
+    d = await db[DOC_COLLECTION].find_one_and_update(
+        {"_id": oid},
+        {"$set": update},
+        projection=DOC_OUT_PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
+    if d is None:
+        raise HTTPException(status_code=404, detail="Document not found")
 
-    update = {"title": payload.title, "tags": payload.tags or [], "notes": payload.notes}
-    db[DOC_COLLECTION].update_one({"_id": oid}, {"$set": update})
+    return _to_out(d)
 
-    d = db[DOC_COLLECTION].find_one({"_id": oid})
-    if not d:
-        raise HTTPException(status_code=404, detail="Document not found")
+async def _delete_grid_files(oid: ObjectId):
+    # Also sweeps files left behind by earlier re-uploads of the same document
+    bucket = get_bucket()
+    file_ids = [f._id async for f in bucket.find({"metadata.doc_id": oid})]
+    await asyncio.gather(*(_delete_grid_file(bucket, file_id) for file_id in file_ids))
 
-    return {
-        "id": str(d["_id"]),
-        "title": d.get("title"),
-        "tags": d.get("tags", []),
-        "notes": d.get("notes"),
-        "mime_type": d.get("mime_type"),
-        "size": d.get("size"),
-        "text_preview": d.get("text_preview"),
-    }
+async def _delete_grid_file(bucket, file_id):
+    # A concurrent delete (or the upload-404 cleanup) may have got there
+    # first; unlike _discard_grid_file, any other error still fails the request
+    try:
+        await bucket.delete(file_id)
+    except NoFile:
+        pass
 
 # Delete document (and its blob if exists)
 @app.delete("/api/documents/{doc_id}")
-async def delete_document(doc_id: str):
+async def delete_document(oid: ObjectId = Depends(_doc_oid)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    try:
-        oid = ObjectId(doc_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid document id")
 
-    d = db[DOC_COLLECTION].find_one({"_id": oid})
-    if not d:
+    # Files are keyed by doc_id, so they can go at the same time as the document
+    deleted, _, _ = await asyncio.gather(
+        db[DOC_COLLECTION].find_one_and_delete({"_id": oid}, projection={"storage_file": 1}),
+        db[FILE_COLLECTION].delete_many({"doc_id": oid}),
+        _delete_grid_files(oid),
+    )
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Document not found")
-
-    if d.get("file_blob_id"):
-        db[FILE_COLLECTION].delete_one({"_id": d["file_blob_id"]})
-    db[DOC_COLLECTION].delete_one({"_id": oid})
+    if STORAGE_PATH and deleted.get("storage_file"):
+        await _remove_file(_storage_file(deleted["storage_file"]))
     return {"status": "deleted"}
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Each worker is its own process with its own Mongo pool, so the database
+    # sees up to WEB_CONCURRENCY * DATABASE_MAX_POOL_SIZE connections; for
+    # production prefer gunicorn -k uvicorn.workers.UvicornWorker --workers=(2*cores)+1
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    uvicorn.run("main:app", host="0.0.0.0", port=port, loop="uvloop", http="httptools", workers=workers)